@@ -1,14 +1,16 @@
 from flask import Flask, render_template, request, jsonify, send_file
 from ortools.sat.python import cp_model
-import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import io
 import json
+import os
+import orjson
 
 app = Flask(__name__)
 
 class ShiftScheduler:
-    def __init__(self, month, year, num_staff, staff_info, requests_off, preferred_shifts, holidays, early_count, middle_count, late_count_min, late_count_max, balance_tolerance=2):
+    def __init__(self, month, year, num_staff, staff_info, requests_off, preferred_shifts, holidays, early_count, middle_count, late_count_min, late_count_max, balance_tolerance=2, num_workers=0, attempt_time_limit=8.0):
         self.month = month
         self.year = year
         self.num_staff = num_staff
@@ -21,6 +23,8 @@ class ShiftScheduler:
         self.late_count_min = late_count_min  # 遅番の最小人数
         self.late_count_max = late_count_max  # 遅番の最大人数
         self.balance_tolerance = balance_tolerance  # 早番・遅番バランスの許容差
+        self.num_workers = num_workers  # CP-SATの並列探索ワーカー数（0=CP-SATの既定値で全コアを使う）
+        self.attempt_time_limit = attempt_time_limit  # 緩和レベル1回あたりの探索時間の上限（秒）
         
         # 月の日数を計算
         if month == 12:
@@ -30,6 +34,14 @@ class ShiftScheduler:
         last_day = next_month - timedelta(days=1)
         self.num_days = last_day.day
         
+        # 休日数（偶数月8日、奇数月9日、固定）と1人あたりの勤務日数
+        self.target_off_days = 8 if month % 2 == 0 else 9
+        self.working_days = self.num_days - self.target_off_days
+        
+        # 1日あたりの必要人数（遅番の最小人数・最大人数で計算）
+        self.min_required = self.early_count + self.middle_count + self.late_count_min
+        self.max_required = self.early_count + self.middle_count + self.late_count_max
+        
         # シフトタイプ: 0=早番, 1=中番, 2=遅番, 3=休み
         self.shifts = ['早番', '中番', '遅番', 'OFF']
         self.shift_times = {
@@ -42,6 +54,31 @@ class ShiftScheduler:
         self.LATE = 2
         self.OFF = 3
         
+        # スタッフ構成の集計（診断情報・失敗理由の分析で使う）
+        self.newbie_count = 0
+        self.nakaban_only_count = 0
+        self.request_counts = {}  # {staff_id: 希望休 + 希望シフトの件数}
+        for s in range(self.num_staff):
+            if self.staff_info[s].get('is_newbie', False):
+                self.newbie_count += 1
+            if self.staff_info[s].get('nakaban_only', False):
+                self.nakaban_only_count += 1
+            self.request_counts[s] = len(self.requests_off.get(s, [])) + len(self.preferred_shifts.get(s, {}))
+        
+        # 診断情報を保存
+        self.diagnostics = {
+            'total_staff': self.num_staff,
+            'required_daily': self.min_required,
+            'required_daily_max': self.max_required,
+            'target_off_days': self.target_off_days,
+            'newbies': self.newbie_count,
+            'nakaban_only': self.nakaban_only_count,
+            'total_requests': sum(self.request_counts.values())
+        }
+        
+        # 貪欲法による初期解（全試行で共通のヒント）。一度だけ作って使い回す
+        self.initial_hint = self._greedy_initial_schedule()
+        
     def create_schedule(self, relax_balance=0, relax_preferences=False, relax_consecutive=False, relax_late_early=False):
         """
         シフトを作成する。制約を段階的に緩和して解を探す。
@@ -52,122 +89,161 @@ class ShiftScheduler:
             relax_consecutive: 連続勤務制約を4日まで緩和するか
             relax_late_early: 遅番→早番制約を緩和するか
         """
+        model, shifts, free_cells = self._build_model(relax_balance, relax_preferences, relax_consecutive, relax_late_early)
+        
+        # ソルバー実行
+        solver = cp_model.CpSolver()
+        solver.parameters.max_time_in_seconds = self.attempt_time_limit
+        # 最適値との差が5%以内の解が見つかれば探索を打ち切る
+        solver.parameters.relative_gap_limit = 0.05
+        # 並列探索のワーカー数は指定された場合のみ上書きする（既定では全コアを使う）
+        # 1コアの環境では既定値が単一ワーカーになり解が見つかりにくいため、2ワーカーにする
+        if self.num_workers > 0:
+            solver.parameters.num_workers = self.num_workers
+        elif (os.cpu_count() or 1) < 2:
+            solver.parameters.num_workers = 2
+        
+        # 貪欲法で作った初期解をヒントとして与える（ウォームスタート）
+        # 確定セルは共有の定数なので除く（同じ変数への重複ヒントはモデル不正になる）
+        hint = self.initial_hint
+        for var, value in zip(shifts[free_cells].flat, hint[free_cells].flat):
+            model.AddHint(var, int(value))
+        
+        status = solver.Solve(model)
+        
+        if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
+            solution = np.array([solver.Value(var) for var in shifts.flat]).reshape(shifts.shape)
+            
+            # 結果を取得
+            schedule = {}
+            off_counters = {}  # 各スタッフの休みカウンター
+            
+            for s in range(self.num_staff):
+                schedule[s] = []
+                off_counters[s] = 1  # OFF1から始める
+                
+                for d in range(self.num_days):
+                    shift = int(np.argmax(solution[s, d]))
+                    if shift == self.OFF:
+                        # 休みに番号を付ける
+                        schedule[s].append(f'OFF{off_counters[s]}')
+                        off_counters[s] += 1
+                    else:
+                        schedule[s].append(self.shifts[shift])
+            return schedule, True, None
+        else:
+            # 失敗理由を生成
+            reasons = self._analyze_failure()
+            return None, False, reasons
+    
+    def _build_model(self, relax_balance, relax_preferences, relax_consecutive, relax_late_early):
+        """
+        緩和レベルに合わせたモデルを構築する
+        
+        Returns:
+            (model, shifts, free_cells)。free_cells は定数化していないセルを示す (num_staff, num_days) の bool 配列
+        """
         model = cp_model.CpModel()
         
-        # 診断情報を保存
-        self.diagnostics = {
-            'total_staff': self.num_staff,
-            'required_daily': self.early_count + self.middle_count + self.late_count_min,
-            'required_daily_max': self.early_count + self.middle_count + self.late_count_max,
-            'target_off_days': 8 if self.month % 2 == 0 else 9,
-            'newbies': sum(1 for s in range(self.num_staff) if self.staff_info[s].get('is_newbie', False)),
-            'nakaban_only': sum(1 for s in range(self.num_staff) if self.staff_info[s].get('nakaban_only', False)),
-            'total_requests': sum(len(self.requests_off.get(s, [])) + len(self.preferred_shifts.get(s, {})) for s in range(self.num_staff))
-        }
+        # 制約7（事前確定）: 希望休・有給・希望シフト（ハード制約時）で決まるセルを集める
+        fixed_cells = {}  # {(s, d): shift}
+        conflicting_prefs = []  # 希望休・有給と重なる希望シフト
+        for s in range(self.num_staff):
+            # 希望休・有給
+            for day in list(self.requests_off.get(s, [])) + list(self.holidays.get(s, [])):
+                if 1 <= day <= self.num_days:
+                    fixed_cells[(s, day - 1)] = self.OFF
+            
+            # 希望シフト
+            if s in self.preferred_shifts and not relax_preferences:
+                for day, shift_type in self.preferred_shifts[s].items():
+                    if 1 <= day <= self.num_days:
+                        # 早番、中番、遅番のみ対応
+                        if shift_type in ['早番', '中番', '遅番']:
+                            shift_idx = ['早番', '中番', '遅番'].index(shift_type)
+                            if fixed_cells.get((s, day - 1), shift_idx) != shift_idx:
+                                conflicting_prefs.append((s, day - 1, shift_idx))
+                            else:
+                                fixed_cells[(s, day - 1)] = shift_idx
         
-        # 変数の作成: shifts[(s, d, shift)] = スタッフsが日dにshiftで勤務するか
-        shifts = {}
+        # 変数の作成: shifts[s, d, shift] = スタッフsが日dにshiftで勤務するか
+        # 確定セルは変数を作らず定数に置き換える
+        shifts = np.empty((self.num_staff, self.num_days, 4), dtype=object)
+        free_cells = np.ones((self.num_staff, self.num_days), dtype=bool)
         for s in range(self.num_staff):
             for d in range(self.num_days):
+                if (s, d) in fixed_cells:
+                    for shift in range(4):
+                        shifts[s, d, shift] = model.NewConstant(1 if shift == fixed_cells[(s, d)] else 0)
+                    free_cells[s, d] = False
+                    continue
                 for shift in range(4):  # 0:早番, 1:中番, 2:遅番, 3:休み
-                    shifts[(s, d, shift)] = model.NewBoolVar(f'shift_s{s}_d{d}_t{shift}')
+                    shifts[s, d, shift] = model.NewBoolVar(f'shift_s{s}_d{d}_t{shift}')
         
         # 制約1: 各スタッフは1日に1つのシフトのみ
         for s in range(self.num_staff):
             for d in range(self.num_days):
-                model.Add(sum(shifts[(s, d, shift)] for shift in range(4)) == 1)
+                model.AddExactlyOne(shifts[s, d].tolist())
         
         # 制約2: 各シフトの人数（Webから指定）
-        late_is_three_vars = []  # 遅番が3名の日を記録
-        late_is_two_vars = []    # 遅番が2名の日を記録
-        late_is_four_plus_vars = []  # 遅番が4名以上の日を記録
+        late_deviation_vars = []  # 遅番の人数と3名との差（絶対値）を記録
         
         for d in range(self.num_days):
             # 早番
-            model.Add(sum(shifts[(s, d, self.EARLY)] for s in range(self.num_staff)) == self.early_count)
+            model.Add(cp_model.LinearExpr.Sum(shifts[:, d, self.EARLY].tolist()) == self.early_count)
             # 中番
-            model.Add(sum(shifts[(s, d, self.MIDDLE)] for s in range(self.num_staff)) == self.middle_count)
+            model.Add(cp_model.LinearExpr.Sum(shifts[:, d, self.MIDDLE].tolist()) == self.middle_count)
             # 遅番（最低2名、上限なし、できるだけ3名を優先）
-            late_count = sum(shifts[(s, d, self.LATE)] for s in range(self.num_staff))
-            model.Add(late_count >= self.late_count_min)
-            # 上限は設定しない（柔軟性を持たせる）
-            if self.late_count_max > 0:
-                model.Add(late_count <= self.late_count_max)
-            
-            # 遅番が3名の日を示すブール変数
-            is_three = model.NewBoolVar(f'late_is_three_d{d}')
-            model.Add(late_count == 3).OnlyEnforceIf(is_three)
-            model.Add(late_count != 3).OnlyEnforceIf(is_three.Not())
-            late_is_three_vars.append(is_three)
+            # 上限が0の場合は設定しない（柔軟性を持たせる）
+            late_upper = self.late_count_max if self.late_count_max > 0 else self.num_staff
+            if late_upper == self.late_count_min:
+                # 最小と最大が同じなら人数は確定しており、目的関数の項も定数になるので変数を作らない
+                model.Add(cp_model.LinearExpr.Sum(shifts[:, d, self.LATE].tolist()) == self.late_count_min)
+                continue
+            late_var = model.NewIntVar(self.late_count_min, late_upper, f'late_count_d{d}')
+            model.Add(late_var == cp_model.LinearExpr.Sum(shifts[:, d, self.LATE].tolist()))
             
-            # 遅番が2名の日を示すブール変数（ペナルティ）
-            is_two = model.NewBoolVar(f'late_is_two_d{d}')
-            model.Add(late_count == 2).OnlyEnforceIf(is_two)
-            model.Add(late_count != 2).OnlyEnforceIf(is_two.Not())
-            late_is_two_vars.append(is_two)
-            
-            # 遅番が4名以上の日を示すブール変数（ペナルティ）
-            is_four_plus = model.NewBoolVar(f'late_is_four_plus_d{d}')
-            model.Add(late_count >= 4).OnlyEnforceIf(is_four_plus)
-            model.Add(late_count < 4).OnlyEnforceIf(is_four_plus.Not())
-            late_is_four_plus_vars.append(is_four_plus)
+            # 遅番の人数と3名との差の絶対値（目的関数でペナルティ）
+            max_deviation = max(abs(self.late_count_min - 3), abs(late_upper - 3))
+            late_deviation = model.NewIntVar(0, max_deviation, f'late_deviation_d{d}')
+            model.AddAbsEquality(late_deviation, late_var - 3)
+            late_deviation_vars.append(late_deviation)
         
         # 制約3: 中番専任スタッフは中番または休みのみ
         for s in range(self.num_staff):
             if self.staff_info[s].get('nakaban_only', False):
                 for d in range(self.num_days):
-                    model.Add(shifts[(s, d, self.EARLY)] == 0)
-                    model.Add(shifts[(s, d, self.LATE)] == 0)
+                    model.Add(shifts[s, d, self.EARLY] == 0)
+                    model.Add(shifts[s, d, self.LATE] == 0)
         
         # 制約4: 連続勤務は3日まで（relax_consecutive=True の場合4日まで）
         max_consecutive = 4 if relax_consecutive else 3
         for s in range(self.num_staff):
             for d in range(self.num_days - max_consecutive):
-                model.Add(sum(shifts[(s, d + i, self.OFF)] for i in range(max_consecutive + 1)) >= 1)
+                model.Add(cp_model.LinearExpr.Sum(shifts[s, d:d + max_consecutive + 1, self.OFF].tolist()) >= 1)
         
         # 制約5: 遅番の次の日は早番にならない（relax_late_early=True の場合は緩和）
         if not relax_late_early:
             for s in range(self.num_staff):
                 for d in range(self.num_days - 1):
-                    model.Add(shifts[(s, d, self.LATE)] + shifts[(s, d + 1, self.EARLY)] <= 1)
+                    model.Add(shifts[s, d, self.LATE] + shifts[s, d + 1, self.EARLY] <= 1)
         
         # 制約6: 新人同士は同一シフト勤務しない
         newbies = [s for s in range(self.num_staff) if self.staff_info[s].get('is_newbie', False)]
         if len(newbies) >= 2:
             for d in range(self.num_days):
                 for shift in [self.EARLY, self.MIDDLE, self.LATE]:
-                    model.Add(sum(shifts[(s, d, shift)] for s in newbies) <= 1)
+                    model.AddAtMostOne(shifts[newbies, d, shift].tolist())
         
-        # 制約7: 希望休・希望シフト
-        for s in range(self.num_staff):
-            # 希望休
-            if s in self.requests_off:
-                for day in self.requests_off[s]:
-                    if 1 <= day <= self.num_days:
-                        model.Add(shifts[(s, day - 1, self.OFF)] == 1)
-            
-            # 有給
-            if s in self.holidays:
-                for day in self.holidays[s]:
-                    if 1 <= day <= self.num_days:
-                        model.Add(shifts[(s, day - 1, self.OFF)] == 1)
-            
-            # 希望シフト
-            if s in self.preferred_shifts and not relax_preferences:
-                # ハード制約として希望シフトを強制
-                for day, shift_type in self.preferred_shifts[s].items():
-                    if 1 <= day <= self.num_days:
-                        # 早番、中番、遅番のみ対応
-                        if shift_type in ['早番', '中番', '遅番']:
-                            shift_idx = ['早番', '中番', '遅番'].index(shift_type)
-                            model.Add(shifts[(s, day - 1, shift_idx)] == 1)
+        # 制約7: 希望休・希望シフト（確定セルは変数の作成時に定数化済み）
+        # 希望休・有給と重なる希望シフトは両立できないため、制約としてそのまま追加する
+        for s, d, shift_idx in conflicting_prefs:
+            model.Add(shifts[s, d, shift_idx] == 1)
         
         # 制約8: 休日数（偶数月8日、奇数月9日、固定）
-        target_off_days = 8 if self.month % 2 == 0 else 9
-        
         for s in range(self.num_staff):
-            off_count = sum(shifts[(s, d, self.OFF)] for d in range(self.num_days))
-            model.Add(off_count == target_off_days)  # 固定
+            off_count = cp_model.LinearExpr.Sum(shifts[s, :, self.OFF].tolist())
+            model.Add(off_count == self.target_off_days)  # 固定
         
         # 制約9: 早番と遅番のバランス（中番専任以外）
         # 各スタッフの早番と遅番の回数がほぼ同じになるように（ハード制約）
@@ -176,13 +252,36 @@ class ShiftScheduler:
             # 中番専任スタッフはスキップ
             if not self.staff_info[s].get('nakaban_only', False):
                 # 早番の回数
-                early_count = sum(shifts[(s, d, self.EARLY)] for d in range(self.num_days))
+                early_count = cp_model.LinearExpr.Sum(shifts[s, :, self.EARLY].tolist())
                 # 遅番の回数
-                late_count = sum(shifts[(s, d, self.LATE)] for d in range(self.num_days))
+                late_count = cp_model.LinearExpr.Sum(shifts[s, :, self.LATE].tolist())
                 
                 # 早番と遅番の差を±(balance_tolerance + relax_balance)日以内に制限（ハード制約）
-                model.Add(early_count - late_count <= adjusted_balance_tolerance)
-                model.Add(late_count - early_count <= adjusted_balance_tolerance)
+                model.AddLinearConstraint(early_count - late_count, -adjusted_balance_tolerance, adjusted_balance_tolerance)
+        
+        # 制約10: 対称性の除去
+        # 属性・希望休・有給・希望シフトがすべて同じスタッフは入れ替えても同じ解になるため、
+        # 同じグループ内では番号順に早番の回数が多い順に並べる
+        # 中番専任は全員が同じ回数だけ中番に入るため、並べる制約は不要
+        staff_groups = {}
+        for s in range(self.num_staff):
+            key = (
+                self.staff_info[s].get('is_newbie', False),
+                self.staff_info[s].get('nakaban_only', False),
+                tuple(sorted(self.requests_off.get(s, []))),
+                tuple(sorted(self.holidays.get(s, []))),
+                tuple(sorted(self.preferred_shifts.get(s, {}).items())),
+            )
+            staff_groups.setdefault(key, []).append(s)
+        
+        for (_, nakaban_only, *_), group in staff_groups.items():
+            if nakaban_only:
+                continue
+            for s1, s2 in zip(group, group[1:]):
+                model.Add(
+                    cp_model.LinearExpr.Sum(shifts[s1, :, self.EARLY].tolist())
+                    >= cp_model.LinearExpr.Sum(shifts[s2, :, self.EARLY].tolist())
+                )
         
         # 目的関数: 希望シフトを最大限考慮 + 遅番3名を優先
         objective_prefs = []
@@ -193,51 +292,110 @@ class ShiftScheduler:
                     if 1 <= day <= self.num_days:
                         if shift_type in ['早番', '中番', '遅番']:
                             shift_idx = ['早番', '中番', '遅番'].index(shift_type)
-                            objective_prefs.append(shifts[(s, day - 1, shift_idx)])
+                            objective_prefs.append(shifts[s, day - 1, shift_idx])
         
-        # 目的関数: 希望達成（重み10）+ 遅番3名の日を増やす（重み5）- 遅番2名の日（重み-3）- 遅番4名以上の日（重み-3）
-        objective_terms = []
-        if objective_prefs:
-            objective_terms.extend([10 * pref for pref in objective_prefs])
+        # 目的関数: 希望達成（重み10）- 遅番の人数と3名との差（1名あたり重み8）
+        objective_vars = []
+        objective_coeffs = []
+        objective_vars.extend(objective_prefs)
+        objective_coeffs.extend([10] * len(objective_prefs))
         # 遅番が3名の日を優先（希望より低い優先度）
-        objective_terms.extend([5 * is_three for is_three in late_is_three_vars])
-        # 遅番が2名の日を抑制（ペナルティ）
-        objective_terms.extend([-3 * is_two for is_two in late_is_two_vars])
-        # 遅番が4名以上の日を抑制（ペナルティ）
-        objective_terms.extend([-3 * is_four_plus for is_four_plus in late_is_four_plus_vars])
+        objective_vars.extend(late_deviation_vars)
+        objective_coeffs.extend([-8] * len(late_deviation_vars))
         
-        if objective_terms:
-            model.Maximize(sum(objective_terms))
+        if objective_vars:
+            model.Maximize(cp_model.LinearExpr.WeightedSum(objective_vars, objective_coeffs))
         
-        # ソルバー実行
-        solver = cp_model.CpSolver()
-        solver.parameters.max_time_in_seconds = 30.0
-        status = solver.Solve(model)
+        return model, shifts, free_cells
+    
+    def _greedy_initial_schedule(self):
+        """
+        貪欲法でおおよその初期解を作る（CP-SATのヒント用、制約を満たすとは限らない）
         
-        if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
-            # 結果を取得
-            schedule = {}
-            off_counters = {}  # 各スタッフの休みカウンター
+        日ごとに、残りの勤務日数が多いスタッフから早番・中番・遅番を割り当てる。
+        希望シフト・希望休・有給、中番専任、遅番→早番、新人同士、連続勤務は考慮するが、
+        バランス制約は早番・遅番の回数が少ない方を優先する程度にとどめる。
+        
+        Returns:
+            shape=(num_staff, num_days, 4) の0/1配列
+        """
+        forced_off = set()
+        for s in range(self.num_staff):
+            for day in list(self.requests_off.get(s, [])) + list(self.holidays.get(s, [])):
+                if 1 <= day <= self.num_days:
+                    forced_off.add((s, day - 1))
+        preferred = {}  # {(s, d): shift}
+        for s in range(self.num_staff):
+            for day, shift_type in self.preferred_shifts.get(s, {}).items():
+                if 1 <= day <= self.num_days and shift_type in ['早番', '中番', '遅番'] and (s, day - 1) not in forced_off:
+                    preferred[(s, day - 1)] = ['早番', '中番', '遅番'].index(shift_type)
+        
+        late_upper = self.late_count_max if self.late_count_max > 0 else self.num_staff
+        
+        remaining_work = [self.working_days] * self.num_staff  # 残りの勤務日数
+        free_days_left = [self.num_days - sum(1 for o, _ in forced_off if o == s) for s in range(self.num_staff)]  # 残りの勤務可能日数
+        consecutive = [0] * self.num_staff  # 直前までの連続勤務日数
+        shift_counts = [[0] * 4 for _ in range(self.num_staff)]  # スタッフごとのシフト別回数
+        hint = np.zeros((self.num_staff, self.num_days, 4), dtype=int)
+        hint[:, :, self.OFF] = 1
+        
+        for d in range(self.num_days):
+            assigned = {}  # {s: shift}
+            for (s, day), shift in preferred.items():
+                if day == d:
+                    assigned[s] = shift
+            
+            # 遅番の人数は、残りの勤務日数の合計を残りの日数で均した人数に合わせる（最小・最大人数の範囲内）
+            daily_workers = -(-sum(remaining_work) // (self.num_days - d))
+            late_target = min(max(daily_workers - self.early_count - self.middle_count, self.late_count_min), late_upper)
+            required = [(self.EARLY, self.early_count), (self.MIDDLE, self.middle_count), (self.LATE, late_target)]
+            
+            # 残りの勤務可能日数に対して残りの勤務日数が多いスタッフを優先する
+            urgency = {s: remaining_work[s] / max(free_days_left[s], 1) for s in range(self.num_staff)}
+            candidates = sorted(
+                (s for s in range(self.num_staff)
+                 if s not in assigned and (s, d) not in forced_off and remaining_work[s] > 0 and consecutive[s] < 3),
+                key=lambda s: -urgency[s]
+            )
+            
+            for shift, count in required:
+                # 早番・遅番は、そのシフトの回数がもう一方より少ないスタッフを優先する
+                if shift == self.EARLY:
+                    ordered = sorted(candidates, key=lambda s: -urgency[s] + 0.1 * (shift_counts[s][self.EARLY] - shift_counts[s][self.LATE]))
+                elif shift == self.LATE:
+                    ordered = sorted(candidates, key=lambda s: -urgency[s] + 0.1 * (shift_counts[s][self.LATE] - shift_counts[s][self.EARLY]))
+                else:
+                    ordered = candidates
+                while sum(1 for v in assigned.values() if v == shift) < count:
+                    for s in ordered:
+                        if s in assigned:
+                            continue
+                        if self.staff_info[s].get('nakaban_only', False) and shift != self.MIDDLE:
+                            continue
+                        if shift == self.EARLY and d > 0 and hint[s, d - 1, self.LATE] == 1:
+                            continue
+                        if self.staff_info[s].get('is_newbie', False) and any(
+                            self.staff_info[o].get('is_newbie', False) for o, v in assigned.items() if v == shift
+                        ):
+                            continue
+                        assigned[s] = shift
+                        break
+                    else:
+                        break
             
             for s in range(self.num_staff):
-                schedule[s] = []
-                off_counters[s] = 1  # OFF1から始める
-                
-                for d in range(self.num_days):
-                    for shift in range(4):
-                        if solver.Value(shifts[(s, d, shift)]) == 1:
-                            if shift == self.OFF:
-                                # 休みに番号を付ける
-                                schedule[s].append(f'OFF{off_counters[s]}')
-                                off_counters[s] += 1
-                            else:
-                                schedule[s].append(self.shifts[shift])
-                            break
-            return schedule, True, None
-        else:
-            # 失敗理由を生成
-            reasons = self._analyze_failure()
-            return None, False, reasons
+                if (s, d) not in forced_off:
+                    free_days_left[s] -= 1
+                if s in assigned:
+                    hint[s, d, self.OFF] = 0
+                    hint[s, d, assigned[s]] = 1
+                    shift_counts[s][assigned[s]] += 1
+                    remaining_work[s] -= 1
+                    consecutive[s] += 1
+                else:
+                    consecutive[s] = 0
+        
+        return hint
     
     def create_schedule_with_relaxation(self):
         """
@@ -246,6 +404,13 @@ class ShiftScheduler:
         Returns:
             (schedule, success, reasons, relaxation_info)
         """
+        # 全員の勤務日数は固定なので、延べ勤務日数が1日の必要人数（最小〜最大）× 日数の範囲外ならどの緩和レベルでも解はない
+        total_working_days = self.num_staff * self.working_days
+        too_few_staff = self.min_required * self.num_days > total_working_days
+        too_many_staff = self.late_count_max > 0 and self.max_required * self.num_days < total_working_days
+        if too_few_staff or too_many_staff:
+            return None, False, self._analyze_failure(), None
+        
         relaxation_attempts = [
             # (relax_balance, relax_preferences, relax_consecutive, relax_late_early, 説明)
             (0, False, False, False, '通常モード（制約緩和なし）'),
@@ -259,14 +424,27 @@ class ShiftScheduler:
             (2, True, True, False, 'バランス+2日 + 希望ソフト + 連続緩和'),
             (0, False, False, True, '遅番→早番制約を緩和'),
             (1, True, False, True, 'バランス+1日 + 希望ソフト + 遅番→早番緩和'),
-            (2, True, True, False, 'バランス+2日 + 希望ソフト + 連続緩和'),
             (3, True, True, False, 'バランス+3日 + 希望ソフト + 連続緩和'),
             (2, True, True, True, 'バランス+2日 + 希望ソフト + 連続緩和 + 遅番→早番緩和'),
             (3, True, True, True, 'バランス+3日 + 希望ソフト + 連続緩和 + 遅番→早番緩和'),
             (4, True, True, True, '最大緩和（バランス+4日 + すべての制約緩和）'),
         ]
         
+        # 有効な希望シフトがなければ、希望シフトのソフト化は結果に影響しない
+        has_preferences = any(
+            1 <= day <= self.num_days and shift_type in ['早番', '中番', '遅番']
+            for prefs in self.preferred_shifts.values()
+            for day, shift_type in prefs.items()
+        )
+        
+        tried = set()
         for relax_balance, relax_preferences, relax_consecutive, relax_late_early, description in relaxation_attempts:
+            # 実質的に同じモデルを既に試した場合はスキップ
+            effective = (relax_balance, relax_preferences and has_preferences, relax_consecutive, relax_late_early)
+            if effective in tried:
+                continue
+            tried.add(effective)
+            
             schedule, success, reasons = self.create_schedule(
                 relax_balance=relax_balance,
                 relax_preferences=relax_preferences,
@@ -298,14 +476,14 @@ class ShiftScheduler:
         reasons = []
         
         # 基本情報の計算
-        min_required = self.early_count + self.middle_count + self.late_count_min
-        max_required = self.early_count + self.middle_count + self.late_count_max
-        target_off_days = 8 if self.month % 2 == 0 else 9
-        working_days = self.num_days - target_off_days
+        min_required = self.min_required
+        max_required = self.max_required
+        target_off_days = self.target_off_days
+        working_days = self.working_days
         
         # カウント情報
-        nakaban_only_count = sum(1 for s in range(self.num_staff) if self.staff_info[s].get('nakaban_only', False))
-        newbie_count = sum(1 for s in range(self.num_staff) if self.staff_info[s].get('is_newbie', False))
+        nakaban_only_count = self.nakaban_only_count
+        newbie_count = self.newbie_count
         non_nakaban_staff = self.num_staff - nakaban_only_count
         
         # 1. スタッフ数不足の詳細チェック
@@ -319,7 +497,20 @@ class ShiftScheduler:
                 'priority': 1
             })
         
-        # 2. 中番専任が多すぎる
+        # 2. スタッフ数が多すぎる（勤務日数が固定のため、全員分の勤務を割り当てきれない）
+        total_working_days = self.num_staff * working_days
+        if self.late_count_max > 0 and max_required * self.num_days < total_working_days:
+            max_staff = max_required * self.num_days // working_days
+            needed_late_max = -(-total_working_days // self.num_days) - self.early_count - self.middle_count
+            reasons.append({
+                'type': 'critical',
+                'title': '❌ スタッフ数に対して勤務枠が足りません',
+                'message': f'勤務日数は1人{working_days}日に固定されています。\n全員の勤務日数の合計: {total_working_days}日（{self.num_staff}名 × {working_days}日）\n勤務枠の上限: {max_required * self.num_days}日（1日最大{max_required}名 × {self.num_days}日）',
+                'suggestion': f'✅ 以下のいずれかを実行してください：\n  1. 遅番の最大人数を{needed_late_max}名以上に増やす（0にすると上限なし）\n  2. スタッフを{self.num_staff - max_staff}名減らす',
+                'priority': 1
+            })
+        
+        # 3. 中番専任が多すぎる
         if nakaban_only_count > self.middle_count:
             excess = nakaban_only_count - self.middle_count
             reasons.append({
@@ -330,7 +521,7 @@ class ShiftScheduler:
                 'priority': 1
             })
         
-        # 3. 新人が多すぎる（新人同士は同一シフト勤務不可）
+        # 4. 新人が多すぎる（新人同士は同一シフト勤務不可）
         if newbie_count >= 3:
             reasons.append({
                 'type': 'warning',
@@ -340,14 +531,10 @@ class ShiftScheduler:
                 'priority': 2
             })
         
-        # 4. 希望が多すぎる（個別チェック）
-        total_requests = 0
+        # 5. 希望が多すぎる（個別チェック）
         staff_with_excess_requests = []
         for s in range(self.num_staff):
-            requests_off_count = len(self.requests_off.get(s, []))
-            preferred_shifts_count = len(self.preferred_shifts.get(s, {}))
-            total = requests_off_count + preferred_shifts_count
-            total_requests += total
+            total = self.request_counts[s]
             
             if total > 2:
                 staff_name = self.staff_info[s]['name']
@@ -363,7 +550,7 @@ class ShiftScheduler:
                 'priority': 2
             })
         
-        # 5. 早番・遅番バランス制約の問題（v7で追加）
+        # 6. 早番・遅番バランス制約の問題（v7で追加）
         if non_nakaban_staff > 0:
             # 早番と遅番のバランスを取るには、十分な勤務日数が必要
             required_working_days_for_balance = 10  # 最低限のバランスを取るために必要な勤務日数
@@ -376,7 +563,7 @@ class ShiftScheduler:
                     'priority': 3
                 })
         
-        # 6. 全体的な制約バランスの問題
+        # 7. 全体的な制約バランスの問題
         avg_working_days_per_staff = (self.num_staff * working_days) / self.num_staff
         min_daily_staff = min_required
         total_shifts_needed = working_days * min_daily_staff
@@ -392,7 +579,7 @@ class ShiftScheduler:
                 'priority': 2
             })
         
-        # 7. 一般的な提案（原因が特定できない場合）
+        # 8. 一般的な提案（原因が特定できない場合）
         if not reasons:
             reasons.append({
                 'type': 'general',
@@ -477,7 +664,8 @@ def generate_schedule():
             if relaxation_info:
                 response_data['relaxation_info'] = relaxation_info
             
-            return jsonify(response_data)
+            # シフト表はレスポンスの大半を占めるため、orjson でバイト列に直接変換する
+            return app.response_class(orjson.dumps(response_data), mimetype='application/json')
         else:
             return jsonify({'success': False, 'message': 'シフトを作成できませんでした。', 'reasons': error_reasons})
     
@@ -487,7 +675,7 @@ def generate_schedule():
 @app.route('/export', methods=['POST'])
 def export_excel():
     try:
-        from openpyxl.styles import PatternFill, Font, Alignment
+        import xlsxwriter
         from datetime import datetime as dt
         
         data = request.json
@@ -496,81 +684,48 @@ def export_excel():
         month = int(data['month'])
         year = int(data['year'])
         
-        # DataFrameを作成
-        df_data = {}
-        df_data['スタッフ名'] = [staff['name'] for staff in schedule]
-        
-        # 曜日付きのカラム名を作成
-        days_of_week = ['日', '月', '火', '水', '木', '金', '土']
-        column_names = []
-        for day in range(1, num_days + 1):
-            date = dt(year, month, day)
-            day_of_week = days_of_week[date.weekday() if date.weekday() != 6 else 0]
-            if date.weekday() == 6:  # 日曜日は0じゃなく6で計算
-                day_of_week = '日'
-            column_names.append(f'{month}/{day}\n{day_of_week}曜')
-            df_data[column_names[-1]] = [staff['shifts'][day - 1] for staff in schedule]
-        
-        df = pd.DataFrame(df_data)
-        
-        # Excelファイルとして出力
+        # Excelファイルとして出力（セルは1回だけ書き込み、行単位でストリーミング）
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='シフト表', index=False)
-            
-            # ワークシートを取得
-            workbook = writer.book
-            worksheet = writer.sheets['シフト表']
-            
-            # 色の定義
-            early_fill = PatternFill(start_color='FFF3CD', end_color='FFF3CD', fill_type='solid')  # 早番
-            middle_fill = PatternFill(start_color='D1ECF1', end_color='D1ECF1', fill_type='solid')  # 中番
-            late_fill = PatternFill(start_color='F8D7DA', end_color='F8D7DA', fill_type='solid')  # 遅番
-            off_fill = PatternFill(start_color='D4EDDA', end_color='D4EDDA', fill_type='solid')  # 休み
-            
-            sunday_fill = PatternFill(start_color='FFCCCC', end_color='FFCCCC', fill_type='solid')  # 日曜
-            saturday_fill = PatternFill(start_color='CCE5FF', end_color='CCE5FF', fill_type='solid')  # 土曜
-            
-            sunday_font = Font(color='CC0000', bold=True)  # 日曜のフォント
-            saturday_font = Font(color='0066CC', bold=True)  # 土曜のフォント
-            
-            # ヘッダーの曜日に色を付ける
-            for col_idx, col_name in enumerate(column_names, start=2):  # 2列目から始まる
-                cell = worksheet.cell(row=1, column=col_idx)
-                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                
-                # 曜日をチェック
-                day_num = int(col_name.split('/')[1].split('\\n')[0])
-                date = dt(year, month, day_num)
-                
-                if date.weekday() == 6:  # 日曜日
-                    cell.fill = sunday_fill
-                    cell.font = sunday_font
-                elif date.weekday() == 5:  # 土曜日
-                    cell.fill = saturday_fill
-                    cell.font = saturday_font
-            
-            # シフトのセルに色を付ける
-            for row_idx in range(2, len(schedule) + 2):  # 2行目からデータ
-                for col_idx in range(2, num_days + 2):  # 2列目からシフトデータ
-                    cell = worksheet.cell(row=row_idx, column=col_idx)
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                    value = str(cell.value)
-                    
-                    if value.startswith('OFF'):
-                        cell.fill = off_fill
-                    elif value == '早番':
-                        cell.fill = early_fill
-                    elif value == '中番':
-                        cell.fill = middle_fill
-                    elif value == '遅番':
-                        cell.fill = late_fill
-            
-            # 列幅を調整
-            worksheet.column_dimensions['A'].width = 15
-            for col_idx in range(2, num_days + 2):
-                worksheet.column_dimensions[worksheet.cell(row=1, column=col_idx).column_letter].width = 12
-        
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('シフト表')
+        
+        # 書式の定義
+        cell_base = {'align': 'center', 'valign': 'vcenter'}
+        shift_formats = {
+            '早番': workbook.add_format({**cell_base, 'bg_color': '#FFF3CD'}),  # 早番
+            '中番': workbook.add_format({**cell_base, 'bg_color': '#D1ECF1'}),  # 中番
+            '遅番': workbook.add_format({**cell_base, 'bg_color': '#F8D7DA'}),  # 遅番
+            'OFF': workbook.add_format({**cell_base, 'bg_color': '#D4EDDA'}),  # 休み
+        }
+        default_format = workbook.add_format(cell_base)
+        
+        header_base = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True}
+        header_format = workbook.add_format(header_base)
+        sunday_format = workbook.add_format({**header_base, 'bg_color': '#FFCCCC', 'font_color': '#CC0000'})  # 日曜
+        saturday_format = workbook.add_format({**header_base, 'bg_color': '#CCE5FF', 'font_color': '#0066CC'})  # 土曜
+        
+        # 列幅を調整（constant_memory モードでは書き込み前に設定する）
+        worksheet.set_column(0, 0, 15)
+        worksheet.set_column(1, num_days, 12)
+        
+        # ヘッダー（曜日付きのカラム名、土日に色を付ける）
+        # 各日の曜日はまとめて一度だけ計算する（0=月曜 ... 5=土曜, 6=日曜）
+        weekdays = [dt(year, month, day).weekday() for day in range(1, num_days + 1)]
+        days_of_week = ['月', '火', '水', '木', '金', '土', '日']
+        weekday_formats = {5: saturday_format, 6: sunday_format}
+        worksheet.write(0, 0, 'スタッフ名', header_format)
+        for day, weekday in enumerate(weekdays, start=1):
+            worksheet.write(0, day, f'{month}/{day}\n{days_of_week[weekday]}曜', weekday_formats.get(weekday, header_format))
+        
+        # シフト（シフト種別ごとの書式で色を付ける）
+        for row_idx, staff in enumerate(schedule, start=1):
+            worksheet.write(row_idx, 0, staff['name'])
+            for col_idx, value in enumerate(staff['shifts'][:num_days], start=1):
+                label = str(value)
+                cell_format = shift_formats['OFF'] if label.startswith('OFF') else shift_formats.get(label, default_format)
+                worksheet.write(row_idx, col_idx, value, cell_format)
+        
+        workbook.close()
         output.seek(0)
         
         return send_file(
@@ -584,6 +739,5 @@ def export_excel():
         return jsonify({'success': False, 'message': f'エラーが発生しました: {str(e)}'})
 
 if __name__ == '__main__':
-    import os
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)